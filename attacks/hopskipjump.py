@@ -1,3 +1,6 @@
+import contextlib
+import warnings
+
 from tqdm import tqdm
 import numpy as np
 import torch
@@ -22,6 +25,12 @@ class HopSkipJump():
         "verbose",
     ]
 
+    # Upper bound on the number of times epsilon is halved in the step size search
+    _max_step_size_halvings = 30
+
+    # Number of random initial trials drawn per sample and forward when searching initial adversarial examples
+    _init_trials_per_round = 10
+
     def __init__(
         self,
         classifier,
@@ -34,12 +43,19 @@ class HopSkipJump():
         max_eval: int = 500,
         init_eval: int = 10,
         init_size: int = 100,
+        batch_size: int = 100,
         verbose: bool = True,
+        compile_model: bool = False,
+        use_cuda_graphs: bool = False,
+        inference_dtype: torch.dtype = torch.float32,
+        seed: int = None,
         rtpt=None
     ):
         self._estimator = classifier
         self.apply_softmax = apply_softmax
         self._input_shape = input_shape
+        self._n_features = int(np.prod(self._input_shape))
+        self._sqrt_n_features = float(np.sqrt(self._n_features))
         self.device = device
         self._targeted = targeted
         self.norm = norm
@@ -48,17 +64,43 @@ class HopSkipJump():
         self.init_eval = init_eval
         self.init_size = init_size
         self.curr_iter = 0
-        self.batch_size = 1
+        self.batch_size = batch_size
         self.verbose = verbose
+        self.compile_model = compile_model
+        self.use_cuda_graphs = use_cuda_graphs
+        self.inference_dtype = inference_dtype
         self._check_params()
         self.curr_iter = 0
         self.rtpt = rtpt
 
+        # One generator on the device shared by all random draws of the attack. Without an explicit seed it is seeded
+        # from the global torch RNG, so `torch.manual_seed` still makes the attack reproducible
+        self._generator = torch.Generator(device=self.device)
+        if seed is None:
+            seed = int(torch.randint(2**62, (1,)))
+        self._generator.manual_seed(seed)
+
         # Set binary search threshold
         if norm == 2:
-            self.theta = 0.01 / np.sqrt(np.prod(self._input_shape))
+            self.theta = 0.01 / self._sqrt_n_features
         else:
-            self.theta = 0.01 / np.prod(self._input_shape)
+            self.theta = 0.01 / self._n_features
+
+        # Capture one CUDA graph per number of evaluations used for the gradient estimation. The graphs only ever replay
+        # one at a time, so they share one input buffer and one memory pool, sized by the largest graph captured first
+        self._cuda_graphs = {}
+        if self.use_cuda_graphs:
+            num_evals = sorted(self._num_evals(), reverse=True)
+            input_buffer = torch.zeros([self.batch_size * num_evals[0]] + list(self._input_shape), device=self.device)
+            pool = torch.cuda.graph_pool_handle()
+            for num_eval in num_evals:
+                self._cuda_graphs[num_eval] = self._capture_graph(input_buffer[:self.batch_size * num_eval], pool)
+
+        # Compile the classifier once and capture the graphs for the batch sizes used during the attack
+        self._static_batch_sizes = []
+        if self.compile_model:
+            self._estimator = torch.compile(classifier, mode="reduce-overhead", dynamic=False)
+            self._warmup()
 
     @property
     def estimator(self):
@@ -116,227 +158,212 @@ class HopSkipJump():
             start = 0
 
         # Get clip_min and clip_max from the classifier or infer them from data
-        clip_min, clip_max = np.min(x), np.max(x)
+        clip_min, clip_max = float(np.min(x)), float(np.max(x))
 
-        # Prediction from the original images
+        # Prediction from the original images, the inputs stay on the device for the whole attack
         #preds = self.estimator.predict(x, batch_size=self.batch_size, numpy=True)
-        input = torch.from_numpy(x).to(self.device) # [2500, 3, 32, 32]
-        output = self.estimator(input)               # [2500, 10]
-        if self.apply_softmax:
-            output = output.softmax(dim=1)
-        preds = torch.argmax(output, dim=1) # [2500]
+        x_adv = torch.tensor(x, dtype=torch.float, device=self.device) # [2500, 3, 32, 32]
+        preds = self._predict(x_adv) # [2500]
 
         # Prediction from the initial adversarial examples if not None
         x_adv_init = kwargs.get("x_adv_init")
 
         if x_adv_init is not None:
+            # Clip once here, the attack only queries samples within the valid input range
+            x_adv_init = torch.clamp(torch.tensor(np.stack(x_adv_init), dtype=torch.float, device=self.device), clip_min, clip_max)
+
             # Add mask param to the x_adv_init
-            for i in range(x.shape[0]):
-                if mask[i] is not None:
-                    x_adv_init[i] = x_adv_init[i] * mask[i] + x[i] * (1 - mask[i])
+            if mask is not None:
+                mask = torch.as_tensor(mask, device=self.device, dtype=torch.float)
+                x_adv_init = x_adv_init * mask + x_adv * (1 - mask)
 
-            # Do prediction on the init
-            init_preds = self.estimator(x_adv_init)
+            # Do prediction on the init in a single batched forward
+            init_preds = self._predict(x_adv_init)
 
         else:
-            init_preds = [None] * len(x)
-            x_adv_init = [None] * len(x)
+            init_preds = None
 
         # Assert that, if attack is targeted, y is provided
         if self.targeted and y is None:
             raise ValueError("Target labels `y` need to be provided for a targeted attack.")
 
-        # Some initial setups
-        x_adv = x.astype(float) # [2500, 3, 32, 32]
+        if y is not None:
+            y = torch.as_tensor(y, device=self.device)
 
-        # Generate the adversarial samples
-        for ind in tqdm(range(len(x_adv)), desc='perturbating samples'):
-            val = x_adv[ind]
+        # Generate the adversarial samples, attacking `batch_size` samples in lockstep. The labels are only ever sliced
+        # per batch on the device, never read back element by element
+        nb_samples = len(x_adv)
+        for batch_start in tqdm(range(0, nb_samples, self.batch_size), desc='perturbating samples'):
+            batch_end = min(batch_start + self.batch_size, nb_samples)
+            batch = slice(batch_start, batch_end)
             self.curr_iter = start
 
-            if self.targeted:
-                x_adv[ind] = self._perturb(
-                    x=val,
-                    y=y[ind],
-                    y_p=preds[ind],
-                    init_pred=init_preds[ind],
-                    adv_init=x_adv_init[ind],
-                    clip_min=clip_min,
-                    clip_max=clip_max,
-                    mask=None
-                )
-
-            else:
-                x_adv[ind] = self._perturb(
-                    x=val,
-                    y=-1,
-                    y_p=preds[ind],
-                    init_pred=init_preds[ind],
-                    adv_init=x_adv_init[ind],
-                    clip_min=clip_min,
-                    clip_max=clip_max,
-                    mask=None
-                )
+            x_adv[batch] = self._perturb(
+                x=x_adv[batch],
+                y=y[batch] if self.targeted else None,
+                y_p=preds[batch],
+                init_pred=None if init_preds is None else init_preds[batch],
+                adv_init=None if init_preds is None else x_adv_init[batch],
+                clip_min=clip_min,
+                clip_max=clip_max,
+                mask=None
+            )
 
             if self.rtpt is not None:
-                self.rtpt.step()
+                for _ in range(batch_end - batch_start):
+                    self.rtpt.step()
 
-        return x_adv
+        return x_adv.cpu().numpy().astype(float)
 
     def _perturb(
         self,
-        x: np.ndarray,
-        y: int,
-        y_p: int,
-        init_pred: int,
-        adv_init: np.ndarray,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        y_p: torch.Tensor,
+        init_pred: torch.Tensor,
+        adv_init: torch.Tensor,
         mask,
         clip_min: float,
         clip_max: float,
-    ) -> np.ndarray:
-        """
-        Internal attack function for one example.
-        :param x: An array with one original input to be attacked.
-        :param y: If `self.targeted` is true, then `y` represents the target label.
-        :param y_p: The predicted label of x.
-        :param init_pred: The predicted label of the initial image.
-        :param adv_init: Initial array to act as an initial adversarial example.
-        :param mask: An array with a mask to be applied to the adversarial perturbations. Shape needs to be
-                    broadcastable to the shape of x. Any features for which the mask is zero will not be adversarially
-                    perturbed.
+    ) -> torch.Tensor:
+        """
+        Internal attack function for a batch of examples.
+        :param x: A tensor with a batch of original inputs to be attacked.
+        :param y: If `self.targeted` is true, then `y` represents the target labels.
+        :param y_p: The predicted labels of x.
+        :param init_pred: The predicted labels of the initial images.
+        :param adv_init: Initial tensor to act as initial adversarial examples.
+        :param mask: A tensor with a mask to be applied to the adversarial perturbations. Shape needs to be
+                    broadcastable to the shape of a single input. Any features for which the mask is zero will not be
+                    adversarially perturbed.
         :param clip_min: Minimum value of an example.
         :param clip_max: Maximum value of an example.
-        :return: An adversarial example.
+        :return: A batch of adversarial examples.
         """
-        # First, create an initial adversarial sample
-        initial_sample = self._init_sample(x, y, y_p, init_pred, adv_init, mask, clip_min, clip_max)
+        # First, create initial adversarial samples
+        initial_sample, found = self._init_sample(x, y, y_p, init_pred, adv_init, mask, clip_min, clip_max)
 
-        # If an initial adversarial example is not found, then return the original image
-        if initial_sample is None:
-            return x
+        # If an initial adversarial example is not found, then keep the original image
+        x_adv = x.clone()
+        if not found.any():
+            return x_adv
 
-        # If an initial adversarial example found, then go with HopSkipJump attack
-        x_adv = self._attack(initial_sample[0], x, initial_sample[1], mask, clip_min, clip_max)
+        # For the samples with an initial adversarial example go with HopSkipJump attack
+        target = y if self.targeted else y_p
+        x_adv[found] = self._attack(initial_sample[found], x[found], target[found], mask, clip_min, clip_max)
 
         return x_adv
 
     def _init_sample(
         self,
-        x: np.ndarray,
-        y: int,
-        y_p: int,
-        init_pred: int,
-        adv_init: np.ndarray,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        y_p: torch.Tensor,
+        init_pred: torch.Tensor,
+        adv_init: torch.Tensor,
         mask,
         clip_min: float,
         clip_max: float
     ):
         """
-        Find initial adversarial example for the attack.
-        :param x: An array with 1 original input to be attacked.
-        :param y: If `self.targeted` is true, then `y` represents the target label.
-        :param y_p: The predicted label of x.
-        :param init_pred: The predicted label of the initial image.
-        :param adv_init: Initial array to act as an initial adversarial example.
-        :param mask: An array with a mask to be applied to the adversarial perturbations. Shape needs to be
-                    broadcastable to the shape of x. Any features for which the mask is zero will not be adversarially
-                    perturbed.
+        Find initial adversarial examples for the attack.
+        :param x: A tensor with a batch of original inputs to be attacked.
+        :param y: If `self.targeted` is true, then `y` represents the target labels.
+        :param y_p: The predicted labels of x.
+        :param init_pred: The predicted labels of the initial images.
+        :param adv_init: Initial tensor to act as initial adversarial examples.
+        :param mask: A tensor with a mask to be applied to the adversarial perturbations. Shape needs to be
+                    broadcastable to the shape of a single input. Any features for which the mask is zero will not be
+                    adversarially perturbed.
         :param clip_min: Minimum value of an example.
         :param clip_max: Maximum value of an example.
-        :return: An adversarial example.
+        :return: The initial adversarial examples and a boolean mask marking the samples for which one was found.
         """
-        nprd = np.random.RandomState()
-        initial_sample = None
+        initial_sample = x.clone()
+        from_init = torch.zeros(len(x), dtype=torch.bool, device=self.device)
 
         if self.targeted:
-            # Attack satisfied
-            if y == y_p:
-                return None
+            target = y
+            # Attack already satisfied, nothing to search for
+            pending = y != y_p
 
             # Attack unsatisfied yet and the initial image satisfied
-            if adv_init is not None and init_pred == y:
-                return adv_init.astype(float), init_pred
-
-            # Attack unsatisfied yet and the initial image unsatisfied
-            for _ in range(self.init_size):
-                random_img = nprd.uniform(clip_min, clip_max, size=x.shape).astype(x.dtype)
-
-                if mask is not None:
-                    random_img = random_img * mask + x * (1 - mask)
-
-                #random_class = self.estimator(torch.from_numpy(np.array([random_img])))[0]
-                input = torch.from_numpy(np.array([random_img])).to(self.device)
-                output = self.estimator(input)
-                random_class = torch.argmax(output, dim=1)
-
-                if random_class == y:
-                    # Binary search to reduce the l2 distance to the original image
-                    random_img = self._binary_search(
-                        current_sample=random_img,
-                        original_sample=x,
-                        target=y,
-                        norm=2,
-                        clip_min=clip_min,
-                        clip_max=clip_max,
-                        threshold=0.001,
-                    )
-                    initial_sample = random_img, random_class
-
+            if adv_init is not None:
+                from_init = pending & (init_pred == y)
         else:
+            target = y_p
+            pending = torch.ones(len(x), dtype=torch.bool, device=self.device)
+
             # The initial image satisfied
-            if adv_init is not None and init_pred != y_p:
-                return adv_init.astype(float), y_p
-
-            # The initial image unsatisfied
-            for _ in range(self.init_size):
-                random_img = nprd.uniform(clip_min, clip_max, size=x.shape).astype(x.dtype) # [3, 32, 32]
-
-                if mask is not None:
-                    random_img = random_img * mask + x * (1 - mask)
-
-                input = torch.from_numpy(np.array([random_img])).to(self.device, dtype=torch.float) # [3, 32, 32]
-                output = self.estimator(input) # [1, 10]
-                random_class = torch.argmax(output, dim=1)
-
-                if random_class != y_p:
-                    # Binary search to reduce the l2 distance to the original image
-                    random_img = self._binary_search(
-                        current_sample=random_img,
-                        original_sample=x,
-                        target=y_p,
-                        norm=2,
-                        clip_min=clip_min,
-                        clip_max=clip_max,
-                        threshold=0.001,
-                    )
-                    initial_sample = random_img, y_p
+            if adv_init is not None:
+                from_init = init_pred != y_p
 
-                    break
+        found = from_init.clone()
+        if adv_init is not None:
+            initial_sample[from_init] = adv_init[from_init]
+            pending &= ~from_init
+
+        # The initial image unsatisfied: draw random images in rounds of a few trials per pending sample, samples that
+        # already have a hit drop out of the following rounds
+        for round_start in range(0, self.init_size, self._init_trials_per_round):
+            idx = pending.nonzero(as_tuple=True)[0]
+            if len(idx) == 0:
+                break
+
+            nb_trials = min(self._init_trials_per_round, self.init_size - round_start)
+            random_img = torch.rand(
+                [len(idx), nb_trials] + list(self._input_shape), generator=self._generator, device=self.device
+            ) * (clip_max - clip_min) + clip_min # [B, nb_trials, 3, 32, 32]
+
+            if mask is not None:
+                random_img = random_img * mask + x[idx].unsqueeze(1) * (1 - mask)
 
-        return initial_sample # [  [3, 32, 32],  [1] ]
+            satisfied = self._adversarial_satisfactory(
+                samples=random_img.flatten(0, 1),
+                target=target[idx].repeat_interleave(nb_trials),
+            ).view(len(idx), nb_trials)
+            hit = satisfied.any(dim=1)
+            first_hit = satisfied.int().argmax(dim=1)
+
+            initial_sample[idx[hit]] = random_img[hit, first_hit[hit]]
+            found[idx[hit]] = True
+            pending[idx[hit]] = False
+
+        # Binary search to reduce the l2 distance to the original images
+        searched = found & ~from_init
+        if searched.any():
+            initial_sample[searched] = self._binary_search(
+                current_sample=initial_sample[searched],
+                original_sample=x[searched],
+                target=target[searched],
+                norm=2,
+                threshold=0.001,
+            )
+
+        return initial_sample, found # [B, 3, 32, 32], [B]
 
     def _attack(
         self,
-        initial_sample: np.ndarray,
-        original_sample: np.ndarray,
-        target: int,
+        initial_sample: torch.Tensor,
+        original_sample: torch.Tensor,
+        target: torch.Tensor,
         mask,
         clip_min: float,
         clip_max: float,
-    ) -> np.ndarray:
+    ) -> torch.Tensor:
         """
         Main function for the boundary attack.
-        :param initial_sample: An initial adversarial example.
-        :param original_sample: The original input.
-        :param target: The target label.
-        :param mask: An array with a mask to be applied to the adversarial perturbations. Shape needs to be
-                    broadcastable to the shape of x. Any features for which the mask is zero will not be adversarially
-                    perturbed.
+        :param initial_sample: A batch of initial adversarial examples.
+        :param original_sample: The original inputs.
+        :param target: The target labels.
+        :param mask: A tensor with a mask to be applied to the adversarial perturbations. Shape needs to be
+                    broadcastable to the shape of a single input. Any features for which the mask is zero will not be
+                    adversarially perturbed.
         :param clip_min: Minimum value of an example.
         :param clip_max: Maximum value of an example.
-        :return: an adversarial example.
+        :return: a batch of adversarial examples.
         """
-        # Set current perturbed image to the initial image
+        # Set current perturbed images to the initial images
         current_sample = initial_sample
 
         # Main loop to wander around the boundary
@@ -355,8 +382,6 @@ class HopSkipJump():
                 original_sample=original_sample,
                 norm=self.norm,
                 target=target,
-                clip_min=clip_min,
-                clip_max=clip_max,
             )
 
             # Next compute the number of evaluations and compute the update
@@ -373,26 +398,32 @@ class HopSkipJump():
             )
 
             # Finally run step size search by first computing epsilon
-            if self.norm == 2:
-                dist = np.linalg.norm(original_sample - current_sample)
-            else:
-                dist = np.max(abs(original_sample - current_sample))
-
+            dist = self._compute_distance(current_sample=current_sample, original_sample=original_sample)
             epsilon = 2.0 * dist / np.sqrt(self.curr_iter + 1)
-            success = False
-
-            while not success:
-                epsilon /= 2.0
-                potential_sample = current_sample + epsilon * update
-                success = self._adversarial_satisfactory(
-                    samples=potential_sample[None],
-                    target=target,
-                    clip_min=clip_min,
-                    clip_max=clip_max,
+            success = torch.zeros(len(current_sample), dtype=torch.bool, device=self.device)
+
+            # Only keep halving epsilon for the samples whose step is not adversarial yet. The successful samples keep
+            # their epsilon, so their potential samples stay the same and only the pending ones are queried again
+            for _ in range(self._max_step_size_halvings):
+                pending = ~success
+                epsilon = torch.where(pending, epsilon / 2.0, epsilon)
+                potential_sample = torch.clamp(current_sample + self._batch_view(epsilon) * update, clip_min, clip_max)
+                success[pending] = self._adversarial_satisfactory(
+                    samples=potential_sample[pending],
+                    target=target[pending],
+                )
+
+                if success.all():
+                    break
+            else:
+                # Samples without an adversarial step stay where they are
+                warnings.warn(
+                    f"Step size search did not succeed for all samples after {self._max_step_size_halvings} halvings."
                 )
+                potential_sample = torch.where(self._batch_view(success), potential_sample, current_sample)
 
             # Update current sample
-            current_sample = np.clip(potential_sample, clip_min, clip_max)
+            current_sample = potential_sample
 
             # Update current iteration
             self.curr_iter += 1
@@ -401,43 +432,38 @@ class HopSkipJump():
 
     def _binary_search(
         self,
-        current_sample: np.ndarray,
-        original_sample: np.ndarray,
-        target: int,
+        current_sample: torch.Tensor,
+        original_sample: torch.Tensor,
+        target: torch.Tensor,
         norm,
-        clip_min: float,
-        clip_max: float,
         threshold=None,
-    ) -> np.ndarray:
+    ) -> torch.Tensor:
         """
         Binary search to approach the boundary.
-        :param current_sample: Current adversarial example.
-        :param original_sample: The original input.
-        :param target: The target label.
+        :param current_sample: A batch of current adversarial examples.
+        :param original_sample: The original inputs.
+        :param target: The target labels.
         :param norm: Order of the norm. Possible values: "inf", np.inf or 2.
-        :param clip_min: Minimum value of an example.
-        :param clip_max: Maximum value of an example.
         :param threshold: The upper threshold in binary search.
-        :return: an adversarial example.
+        :return: a batch of adversarial examples.
         """
         # First set upper and lower bounds as well as the threshold for the binary search
+        lower_bound = torch.zeros(len(current_sample), device=self.device)
         if norm == 2:
-            (upper_bound, lower_bound) = (1, 0)
+            upper_bound = torch.ones(len(current_sample), device=self.device)
 
             if threshold is None:
                 threshold = self.theta
 
         else:
-            (upper_bound, lower_bound) = (
-                np.max(abs(original_sample - current_sample)),
-                0,
-            )
+            upper_bound = (original_sample - current_sample).abs().flatten(1).amax(dim=1)
 
             if threshold is None:
-                threshold = np.minimum(upper_bound * self.theta, self.theta)
+                threshold = torch.clamp(upper_bound * self.theta, max=self.theta)
 
-        # Then start the binary search
-        while (upper_bound - lower_bound) > threshold:
+        # Then start the binary search on the whole batch, samples whose bracket is already small enough keep it
+        active = (upper_bound - lower_bound) > threshold
+        while active.any():
             # Interpolation point
             alpha = (upper_bound + lower_bound) / 2.0
             interpolated_sample = self._interpolate(
@@ -449,13 +475,12 @@ class HopSkipJump():
 
             # Update upper_bound and lower_bound
             satisfied = self._adversarial_satisfactory(
-                samples=interpolated_sample[None],
+                samples=interpolated_sample,
                 target=target,
-                clip_min=clip_min,
-                clip_max=clip_max,
-            )[0]
-            lower_bound = np.where(satisfied.cpu() == 0, alpha, lower_bound)
-            upper_bound = np.where(satisfied.cpu() == 1, alpha, upper_bound)
+            )
+            lower_bound = torch.where(active & ~satisfied, alpha, lower_bound)
+            upper_bound = torch.where(active & satisfied, alpha, upper_bound)
+            active = (upper_bound - lower_bound) > threshold
 
         result = self._interpolate(
             current_sample=current_sample,
@@ -464,122 +489,127 @@ class HopSkipJump():
             norm=norm,
         )
 
-        return result # [3, 32, 32]
+        return result # [B, 3, 32, 32]
 
     def _compute_delta(
         self,
-        current_sample: np.ndarray,
-        original_sample: np.ndarray,
+        current_sample: torch.Tensor,
+        original_sample: torch.Tensor,
         clip_min: float,
         clip_max: float,
-    ) -> float:
+    ) -> torch.Tensor:
         """
         Compute the delta parameter.
-        :param current_sample: Current adversarial example.
-        :param original_sample: The original input.
+        :param current_sample: A batch of current adversarial examples.
+        :param original_sample: The original inputs.
         :param clip_min: Minimum value of an example.
         :param clip_max: Maximum value of an example.
-        :return: Delta value.
+        :return: Delta values, one per sample.
         """
         # Note: This is a bit different from the original paper, instead we keep those that are
         # implemented in the original source code of the authors
         if self.curr_iter == 0:
-            return 0.1 * (clip_max - clip_min)
+            return torch.full((len(current_sample),), 0.1 * (clip_max - clip_min), device=self.device)
+
+        dist = self._compute_distance(current_sample=current_sample, original_sample=original_sample)
+        scale = self._sqrt_n_features if self.norm == 2 else self._n_features
 
+        return scale * self.theta * dist
+
+    def _compute_distance(self, current_sample: torch.Tensor, original_sample: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the distance of each sample to its original input in the attack norm.
+        :param current_sample: A batch of current adversarial examples.
+        :param original_sample: The original inputs.
+        :return: Distances, one per sample.
+        """
+        diff = (original_sample - current_sample).flatten(1)
         if self.norm == 2:
-            dist = np.linalg.norm(original_sample - current_sample)
-            delta = np.sqrt(np.prod(self._input_shape)) * self.theta * dist
-        else:
-            dist = np.max(abs(original_sample - current_sample))
-            delta = np.prod(self._input_shape) * self.theta * dist
+            return torch.linalg.norm(diff, dim=1)
 
-        return delta
+        return diff.abs().amax(dim=1)
 
     def _compute_update(
         self,
-        current_sample: np.ndarray,
+        current_sample: torch.Tensor,
         num_eval: int,
-        delta: float,
-        target: int,
+        delta: torch.Tensor,
+        target: torch.Tensor,
         mask,
         clip_min: float,
         clip_max: float,
-    ) -> np.ndarray:
+    ) -> torch.Tensor:
         """
         Compute the update in Eq.(14).
-        :param current_sample: Current adversarial example.
-        :param num_eval: The number of evaluations for estimating gradient.
-        :param delta: The size of random perturbation.
-        :param target: The target label.
-        :param mask: An array with a mask to be applied to the adversarial perturbations. Shape needs to be
-                    broadcastable to the shape of x. Any features for which the mask is zero will not be adversarially
-                    perturbed.
+        :param current_sample: A batch of current adversarial examples.
+        :param num_eval: The number of evaluations per sample for estimating gradient.
+        :param delta: The size of random perturbation for each sample.
+        :param target: The target labels.
+        :param mask: A tensor with a mask to be applied to the adversarial perturbations. Shape needs to be
+                    broadcastable to the shape of a single input. Any features for which the mask is zero will not be
+                    adversarially perturbed.
         :param clip_min: Minimum value of an example.
         :param clip_max: Maximum value of an example.
-        :return: an updated perturbation.
+        :return: a batch of updated perturbations.
         """
+        n = len(current_sample)
+
         # Generate random noise
-        rnd_noise_shape = [num_eval] + list(self._input_shape)
+        rnd_noise_shape = [n, num_eval] + list(self._input_shape)
         if self.norm == 2:
-            rnd_noise = np.random.randn(*rnd_noise_shape).astype(np.float32)
+            rnd_noise = torch.randn(rnd_noise_shape, generator=self._generator, device=self.device, dtype=torch.float32)
         else:
-            rnd_noise = np.random.uniform(low=-1, high=1, size=rnd_noise_shape).astype(np.float32)
+            rnd_noise = torch.rand(
+                rnd_noise_shape, generator=self._generator, device=self.device, dtype=torch.float32
+            ) * 2 - 1
 
         # With mask
         if mask is not None:
             rnd_noise = rnd_noise * mask
 
         # Normalize random noise to fit into the range of input data
-        rnd_noise = rnd_noise / np.sqrt(
-            np.sum(rnd_noise**2, axis=tuple(range(len(rnd_noise_shape)))[1:], keepdims=True)
+        rnd_noise = rnd_noise / torch.linalg.norm(rnd_noise.reshape(n, num_eval, -1), dim=2).view(
+            [n, num_eval] + [1] * len(self._input_shape)
         )
-        eval_samples = np.clip(current_sample + delta * rnd_noise, clip_min, clip_max)
-        rnd_noise = (eval_samples - current_sample) / delta
+        delta = self._batch_view(delta)[:, None]
+        eval_samples = torch.clamp(current_sample[:, None] + delta * rnd_noise, clip_min, clip_max)
+        rnd_noise = (eval_samples - current_sample[:, None]) / delta
 
         # Compute gradient: This is a bit different from the original paper, instead we keep those that are
         # implemented in the original source code of the authors
         satisfied = self._adversarial_satisfactory(
-            samples=eval_samples, target=target, clip_min=clip_min, clip_max=clip_max
+            samples=eval_samples.reshape([n * num_eval] + list(self._input_shape)),
+            target=target.repeat_interleave(num_eval),
+            num_eval=num_eval,
         )
 
-        shape = [num_eval] + [1] * len(self._input_shape)
+        f_val = 2.0 * satisfied.float().view(n, num_eval) - 1.0
 
-        f_val = 2 * satisfied.reshape([num_eval] + [1] * len(self._input_shape)) - 1.0
-        f_val = f_val.cpu().numpy().astype(np.float32)
-
-        if np.mean(f_val) == 1.0:
-            grad = np.mean(rnd_noise, axis=0)
-        elif np.mean(f_val) == -1.0:
-            grad = -np.mean(rnd_noise, axis=0)
-        else:
-            f_val -= np.mean(f_val)
-            grad = np.mean(f_val * rnd_noise, axis=0)
+        # If all evaluations of a sample agree, the plain mean of the noise is used, otherwise the baseline is removed
+        f_mean = torch.mean(f_val, dim=1, keepdim=True)
+        f_val = torch.where(f_mean.abs() == 1.0, f_val, f_val - f_mean)
+        grad = torch.einsum("be,be...->b...", f_val, rnd_noise) / num_eval
 
         # Compute update
         if self.norm == 2:
-            result = grad / np.linalg.norm(grad)
+            result = grad / self._batch_view(torch.linalg.norm(grad.flatten(1), dim=1))
         else:
-            result = np.sign(grad)
+            result = torch.sign(grad)
 
         return result
 
     def _adversarial_satisfactory(
-        self, samples: np.ndarray, target: int, clip_min: float, clip_max: float
-    ) -> np.ndarray:
+        self, samples: torch.Tensor, target: torch.Tensor, num_eval: int = None
+    ) -> torch.Tensor:
         """
-        Check whether an image is adversarial.
+        Check whether images are adversarial. The samples are not clipped here, callers pass samples that already lie
+        within the valid input range.
         :param samples: A batch of examples.
-        :param target: The target label.
-        :param clip_min: Minimum value of an example.
-        :param clip_max: Maximum value of an example.
-        :return: An array of 0/1.
+        :param target: The target label of each example.
+        :param num_eval: The number of evaluations per sample if the batch comes from the gradient estimation.
+        :return: A boolean tensor on the device.
         """
-        samples = np.clip(samples, clip_min, clip_max)
-        input = torch.from_numpy(samples).to(self.device, dtype=torch.float)
-        output = self.estimator(input) # [1,10]
-        if self.apply_softmax:
-            output = output.softmax(dim=1)
-        preds = torch.argmax(output, dim=1)
+        preds = self._predict(samples, num_eval=num_eval)
 
         if self.targeted:
             result = preds == target
@@ -588,20 +618,121 @@ class HopSkipJump():
 
         return result
 
+    def _predict(self, samples: torch.Tensor, num_eval: int = None) -> torch.Tensor:
+        """
+        Predict the labels of a batch of examples. Batches of the gradient estimation replay the CUDA graph captured for
+        their number of evaluations. With a compiled classifier the batch is zero-padded to the smallest warmed up batch
+        size that fits, so only a handful of specialized graphs are captured.
+        :param samples: A batch of examples.
+        :param num_eval: The number of evaluations per sample if the batch comes from the gradient estimation.
+        :return: The predicted labels.
+        """
+        nb_samples = len(samples)
+        if num_eval in self._cuda_graphs:
+            static_input, static_output, graph = self._cuda_graphs[num_eval]
+            if nb_samples <= len(static_input):
+                static_input[:nb_samples].copy_(samples)
+                graph.replay()
+                # Return a copy, the next replay of this graph overwrites the static output
+                return static_output[:nb_samples].clone()
+
+        if self.compile_model:
+            padding = self._padded_size(nb_samples) - nb_samples
+            if padding > 0:
+                samples = torch.cat([samples, samples.new_zeros([padding] + list(samples.shape[1:]))])
+
+        # Inference mode is only available from PyTorch 1.9 on, older versions fall back to no_grad
+        inference_mode = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+        with inference_mode(), self._autocast():
+            output = self.estimator(samples)[:nb_samples] # [B, 10]
+
+        # Softmax is monotonic, so the labels do not depend on `apply_softmax` and it is skipped
+        return torch.argmax(output, dim=1)
+
+    def _autocast(self):
+        """
+        Return the autocast context for the forwards. Only the predicted labels are used, so half precision is enough.
+        """
+        if self.inference_dtype == torch.float32:
+            return contextlib.nullcontext()
+
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=self.inference_dtype)
+
+    def _num_evals(self) -> set:
+        """
+        Collect the numbers of evaluations the gradient estimation uses over `max_iter` iterations.
+        """
+        return {min(int(self.init_eval * np.sqrt(i + 1)), self.max_eval) for i in range(self.max_iter)}
+
+    def _capture_graph(self, static_input: torch.Tensor, pool):
+        """
+        Capture the prediction of a fixed-size batch in a CUDA graph. Only the freed intermediates are shared with the
+        other graphs through the pool, the static output stays referenced and is overwritten by every replay of this
+        graph.
+        :param static_input: The input tensor the graph reads from on every replay.
+        :param pool: The memory pool shared by all captured graphs.
+        :return: The static input, the static output and the captured graph.
+        """
+        # Warm up on a side stream before capturing, as required by CUDA graphs
+        stream = torch.cuda.Stream(device=self.device)
+        stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._predict(static_input)
+        torch.cuda.current_stream(self.device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=pool):
+            static_output = self._predict(static_input)
+
+        return static_input, static_output, graph
+
+    def _warmup(self) -> None:
+        """
+        Run the compiled classifier once for a small set of batch sizes that smaller batches are padded to.
+        """
+        # The classifier is compiled with `dynamic=False`, so every batch size is its own recompile. Keep the set at
+        # five sizes or less, below Dynamo's default recompile limit of 8: a full chunk, one round of initial trials,
+        # and the smallest, median and largest gradient estimation batch
+        num_evals = sorted(self._num_evals())
+        batch_sizes = {self.batch_size, self.batch_size * min(self._init_trials_per_round, self.init_size)}
+        batch_sizes |= {self.batch_size * num_evals[i] for i in (0, len(num_evals) // 2, -1)}
+        self._static_batch_sizes = sorted(batch_sizes)
+
+        for batch_size in self._static_batch_sizes:
+            self._predict(torch.zeros([batch_size] + list(self._input_shape), device=self.device))
+
+    def _padded_size(self, nb_samples: int) -> int:
+        """
+        Round a batch size up to the smallest warmed up batch size that fits, or to the next power of two above them.
+        """
+        for batch_size in self._static_batch_sizes:
+            if batch_size >= nb_samples:
+                return batch_size
+
+        return 1 << (nb_samples - 1).bit_length()
+
+    def _batch_view(self, values):
+        """
+        Reshape per-sample values of shape `(nb_samples,)` to broadcast against a batch of inputs.
+        """
+        return values.reshape([-1] + [1] * len(self._input_shape))
+
     @staticmethod
     def _interpolate(current_sample, original_sample, alpha, norm):
         """
-        Interpolate a new sample based on the original and the current samples.
-        :param current_sample: Current adversarial example.
-        :param original_sample: The original input.
-        :param alpha: The coefficient of interpolation.
+        Interpolate new samples based on the original and the current samples.
+        :param current_sample: A batch of current adversarial examples.
+        :param original_sample: The original inputs.
+        :param alpha: The coefficient of interpolation for each sample.
         :param norm: Order of the norm. Possible values: "inf", np.inf or 2.
-        :return: An adversarial example.
+        :return: A batch of adversarial examples.
         """
+        alpha = alpha.reshape([-1] + [1] * (current_sample.dim() - 1))
         if norm == 2:
-            result = (1 - alpha) * original_sample + alpha * current_sample
+            result = torch.lerp(original_sample, current_sample, alpha)
         else:
-            result = np.clip(current_sample, original_sample - alpha, original_sample + alpha)
+            result = torch.min(torch.max(current_sample, original_sample - alpha), original_sample + alpha)
 
         return result
 
@@ -610,20 +741,39 @@ class HopSkipJump():
         if self.norm not in [2, np.inf, "inf"]:
             raise ValueError('Norm order must be either 2, `np.inf` or "inf".')
 
-        if not isinstance(self.max_iter, (int, np.int)) or self.max_iter < 0:
+        if not isinstance(self.max_iter, (int, np.integer)) or self.max_iter < 0:
             raise ValueError("The number of iterations must be a non-negative integer.")
 
-        if not isinstance(self.max_eval, (int, np.int)) or self.max_eval <= 0:
+        if not isinstance(self.max_eval, (int, np.integer)) or self.max_eval <= 0:
             raise ValueError("The maximum number of evaluations must be a positive integer.")
 
-        if not isinstance(self.init_eval, (int, np.int)) or self.init_eval <= 0:
+        if not isinstance(self.init_eval, (int, np.integer)) or self.init_eval <= 0:
             raise ValueError("The initial number of evaluations must be a positive integer.")
 
         if self.init_eval > self.max_eval:
             raise ValueError("The maximum number of evaluations must be larger than the initial number of evaluations.")
 
-        if not isinstance(self.init_size, (int, np.int)) or self.init_size <= 0:
+        if not isinstance(self.init_size, (int, np.integer)) or self.init_size <= 0:
             raise ValueError("The number of initial trials must be a positive integer.")
 
+        if not isinstance(self.batch_size, (int, np.integer)) or self.batch_size <= 0:
+            raise ValueError("The batch size must be a positive integer.")
+
         if not isinstance(self.verbose, bool):
             raise ValueError("The argument `verbose` has to be of type bool.")
+
+        if self.compile_model and not hasattr(torch, "compile"):
+            raise ValueError("The argument `compile_model` requires `torch.compile` (PyTorch 2.0 or newer).")
+
+        if self.inference_dtype not in [torch.float32, torch.float16, torch.bfloat16]:
+            raise ValueError("The inference dtype must be either `torch.float32`, `torch.float16` or `torch.bfloat16`.")
+
+        if self.inference_dtype != torch.float32 and not hasattr(torch, "autocast"):
+            raise ValueError("Half precision inference requires `torch.autocast` (PyTorch 1.10 or newer).")
+
+        if self.use_cuda_graphs:
+            if not hasattr(torch.cuda, "graph") or torch.device(self.device).type != "cuda":
+                raise ValueError("The argument `use_cuda_graphs` requires a CUDA device and PyTorch 1.10 or newer.")
+
+            if self.compile_model:
+                raise ValueError("The arguments `use_cuda_graphs` and `compile_model` cannot be combined.")